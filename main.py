@@ -1,17 +1,15 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
-import tempfile
+import io
 import argparse
 import sys
+from urllib.parse import urlparse
 import numpy as np
-import aiohttp
 # from aiocron import crontab  # No longer needed
 from pyppeteer import launch
 from PIL import Image
-import PIL.ImageOps
 
-# TODO fix ignored KeyboardInterrupt when running in the the event loop (run_forever)
 # TODO implement proper reset and shutdown of the screen when the systemd service is stopped or the raspberry pi is shut down
 # TODO maybe a "last updated" time (just a clock module with a different header)
 
@@ -30,43 +28,69 @@ is_topdown = False
 wait_to_load = 90		# Page load timeout
 wait_after_load = 60		# Time to evaluate the JS afte the page load (f.e. to lazy-load the calendar data) default=18
 url = 'http://localhost:8080'	# URL to create the screenshot of
+page_hash_file = '/tmp/magicmirror-eink.hash'	# Content hash of the last displayed page, unchanged pages are not redrawn
+
+# Cheap hash over the modules of the page. The clock module is left out since it changes on every
+# refresh, and the class names are included since f.e. weather icons only change a CSS class
+page_hash_js = '''() => {
+    const modules = Array.from(document.querySelectorAll('.module:not(.clock)'));
+    const s = modules.map(m => [
+        m.id,
+        m.getAttribute('class'),
+        m.innerText,
+        ...Array.from(m.querySelectorAll('[class]'), e => e.getAttribute('class'))
+    ].join('|')).join('\\n');
+    let x = 0;
+    for (let i = 0; i < s.length; i++) {
+        x = ((x << 5) - x + s.charCodeAt(i)) | 0;
+    }
+    return x;
+}'''
 
 def reset_screen():
     # epd = epd7in5_V2.EPD()
     epd = EPD()
     epd.init()
-    Limage = Image.new('1', (epd.height, epd.width), 255)  # 255: clear the frame
-    epd.display(epd.getbuffer(Limage))
+    epd.Clear()
 
 
 async def check_server_availability():
+    # A plain TCP connect is enough to know that the server is up, no need for a full HTTP client
+    parsed_url = urlparse(url)
+    port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=5) as response:
-                return response.status == 200
+        _, writer = await asyncio.wait_for(asyncio.open_connection(parsed_url.hostname, port), timeout=5)
+        writer.close()
+        await writer.wait_closed()
+        return True
     except Exception as e:
         logging.error(f"Server not available: {str(e)}")
         return False
 
-async def create_screenshot(file_path):
-    global display_width
-    global display_height
-    global wait_to_load
-    global wait_after_load
-    global url
-    logging.info('Creating screenshot')
-    
-    # Check if server is available first
-    logging.info(f'Checking if server is available at {url}')
-    if not await check_server_availability():
-        raise Exception(f"MagicMirror server is not available at {url}. Please make sure it's running.")
-    logging.info('Server is available')
-    
-    browser = None
+def load_page_hash():
     try:
+        with open(page_hash_file) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_page_hash(page_hash):
+    try:
+        with open(page_hash_file, 'w') as f:
+            f.write(str(page_hash))
+    except OSError as e:
+        logging.warning(f"Could not save page hash: {str(e)}")
+
+# Browser instance and MagicMirror page shared by all refreshes of this process, see get_browser() and load_page()
+_browser = None
+_page = None
+
+async def get_browser():
+    global _browser
+    if _browser is None:
         logging.info('Launching browser')
         # Simplified browser launch configuration for low-resource environments
-        browser = await launch({
+        _browser = await launch({
             'headless': True,
             'executablePath': '/usr/bin/chromium-browser',
             'args': [
@@ -93,34 +117,79 @@ async def create_screenshot(file_path):
             'dumpio': True
         })
         logging.info('Browser launched successfully')
+    return _browser
 
-        logging.info('Creating new page')
-        page = await browser.newPage()
-        
-        logging.info(f'Setting viewport to {display_width}x{display_height}')
-        # Set a smaller viewport to reduce memory usage
-        await page.setViewport({
-            "width": display_width,
-            "height": display_height,
-            "deviceScaleFactor": 1
-        })
-        logging.info('Viewport set')
-        
-        # Set a shorter timeout for navigation
-        logging.info(f'Navigating to {url} (timeout: {wait_to_load}s)')
+async def close_browser():
+    global _browser
+    global _page
+    _page = None
+    if _browser is None:
+        return
+    browser = _browser
+    _browser = None
+    # Ensure browser closes with timeout
+    try:
+        await asyncio.wait_for(browser.close(), timeout=5)
+    except asyncio.TimeoutError:
+        logging.warning("Browser close timed out, forcing kill")
         try:
-            await page.goto(url, timeout=wait_to_load * 1000, waitUntil='domcontentloaded')
+            browser.process.kill()
+        except:
+            pass
+    except Exception as e:
+        logging.warning(f"Error closing browser: {str(e)}")
+
+async def load_page():
+    # The page is opened once and only reloaded on later refreshes, which keeps the browser
+    # cache and skips setting up a new page. main() runs a single refresh per process and
+    # refresh_once() closes the browser afterwards, so the reload branch is only taken by a
+    # long-running caller that calls refresh() repeatedly
+    global _page
+    if _page is not None and not _page.isClosed():
+        logging.info(f'Reloading {url} (timeout: {wait_to_load}s)')
+        await _page.reload(timeout=wait_to_load * 1000, waitUntil='domcontentloaded')
+        return _page
+
+    browser = await get_browser()
+
+    logging.info('Creating new page')
+    page = await browser.newPage()
+    
+    logging.info(f'Setting viewport to {display_width}x{display_height}')
+    # Set a smaller viewport to reduce memory usage
+    await page.setViewport({
+        "width": display_width,
+        "height": display_height,
+        "deviceScaleFactor": 1
+    })
+    logging.info('Viewport set')
+    
+    # Set a shorter timeout for navigation
+    logging.info(f'Navigating to {url} (timeout: {wait_to_load}s)')
+    await page.goto(url, timeout=wait_to_load * 1000, waitUntil='domcontentloaded')
+    _page = page
+    return page
+
+async def create_screenshot():
+    global display_width
+    global display_height
+    global wait_to_load
+    global wait_after_load
+    global url
+    logging.info('Creating screenshot')
+    
+    # Check if server is available first
+    logging.info(f'Checking if server is available at {url}')
+    if not await check_server_availability():
+        raise Exception(f"MagicMirror server is not available at {url}. Please make sure it's running.")
+    logging.info('Server is available')
+    
+    try:
+        try:
+            page = await load_page()
             logging.info('Page navigation completed')
         except Exception as e:
             logging.error(f"Navigation failed: {str(e)}")
-            if browser:
-                try:
-                    await asyncio.wait_for(browser.close(), timeout=5)
-                except (asyncio.TimeoutError, Exception):
-                    try:
-                        browser.process.kill()
-                    except:
-                        pass
             raise Exception(f"Failed to load {url}. Please check if the server is running and accessible.")
         
         # Wait for any remaining network activity to settle
@@ -133,56 +202,87 @@ async def create_screenshot(file_path):
         except Exception as e:
             logging.warning(f"Wait after load failed: {str(e)}")
         
+        # Skip the screenshot if the page looks the same as on the last refresh
+        page_hash = await page.evaluate(page_hash_js)
+        if page_hash == load_page_hash():
+            logging.info('Page content unchanged since the last refresh')
+            return page_hash, None
+        
         # Take screenshot with increased timeout
-        logging.info(f'Taking screenshot (saving to {file_path})')
+        # The screenshot is returned as PNG bytes in memory instead of being written to a file. PNG is kept
+        # over JPEG since chroma subsampling smears thin red lines below the red threshold
+        logging.info('Taking screenshot')
         try:
-            await page.screenshot({'path': file_path, 'timeout': 30000})  # 30 second timeout for screenshot
-            logging.info('Screenshot saved successfully')
+            screenshot = await page.screenshot({'timeout': 30000})  # 30 second timeout for screenshot
+            logging.info('Screenshot taken successfully')
         except Exception as e:
             logging.error(f"Screenshot failed: {str(e)}")
             raise
         
-        # Ensure browser closes with timeout
-        try:
-            await asyncio.wait_for(browser.close(), timeout=5)
-        except asyncio.TimeoutError:
-            logging.warning("Browser close timed out, forcing kill")
-            try:
-                browser.process.kill()
-            except:
-                pass
-        except Exception as e:
-            logging.warning(f"Error closing browser: {str(e)}")
         logging.debug('Finished creating screenshot')
+        return page_hash, screenshot
     except Exception as e:
         logging.error(f'Error creating screenshot: {str(e)}')
-        if browser:
-            try:
-                await asyncio.wait_for(browser.close(), timeout=5)
-            except (asyncio.TimeoutError, Exception):
-                try:
-                    browser.process.kill()
-                except:
-                    pass
+        # Don't hand a possibly broken browser to the next refresh
+        await close_browser()
         raise
 
 
-def remove_aliasing_artefacts(image):
-    red = (255,000,000)
-    black = (000,000,000)
-    white = (255,255,255)
-    img = image.convert('RGB')
-    data = np.array(img)
-    # If the R value of the pixel is less than 50, make it black
-    black_mask = np.bitwise_and(data[:,:,0] <= 230, data[:,:,1] <= 135, data[:,:,2] <= 135)
-    # If the R value is higher than
-    red_mask = np.bitwise_and(data[:,:,0] >= 230, data[:,:,1] <= 135, data[:,:,2] <= 135)
-    # Everything else should be white
-    white_mask = np.bitwise_not(np.bitwise_or(red_mask, black_mask))
-    data[black_mask] = black
-    data[red_mask] = red
-    data[white_mask] = white
-    return Image.fromarray(data, mode='RGB')
+def classify_pixels(data):
+    # Takes an (H, W, 3) uint8 RGB array and returns an (H, W) uint8 array of pixel classes
+    # If the R value is high, make it red (class 1), otherwise black (class 0)
+    classes = (data[:,:,0] >= 230).view(np.uint8)
+    # Pixels with a high G or B value should be white (class 2)
+    light_mask = data[:,:,1] > 135
+    light_mask |= data[:,:,2] > 135
+    np.copyto(classes, 2, where=light_mask)
+    return classes
+
+
+def create_buffers(epd, rgb):
+    # Returns the black and red planes in the packed 1-bit layout of epd.getbuffer, without
+    # going through PIL images. Same orientation handling as epd.getbuffer
+    if rgb.shape[:2] == (epd.width, epd.height):
+        rgb = np.rot90(rgb)
+
+    # Sort every pixel into black, red or white
+    classes = classify_pixels(rgb)
+
+    # Split the image into black and red planes (a cleared bit is ink), the mirror is shown
+    # inverted (white on black) so the white pixels are the ones inked on the black plane.
+    # The ink masks are packed and then inverted so a partial last byte is padded with paper,
+    # like in epd.getbuffer
+    black_bits = ~np.packbits(classes == 2, axis=1)
+    red_bits = ~np.packbits(classes == 1, axis=1)
+    return black_bits.ravel().tolist(), red_bits.ravel().tolist()
+
+
+def prepare_buffers(epd, image):
+    # The viewport is set to the display size, so the screenshot can only be larger if it was
+    # rendered with a higher pixel ratio, in which case a box filter reduce is enough. Any other
+    # size is resized bilinearly, the pixels get snapped to three colors afterwards anyway
+    if image.size != (display_width, display_height):
+        factor = image.size[0] // display_width
+        if factor > 1 and image.size == (display_width * factor, display_height * factor):
+            logging.debug(f'Reducing image from {image.size} to ({display_width}, {display_height})')
+            image = image.reduce(factor)
+        else:
+            logging.debug(f'Resizing image from {image.size} to ({display_width}, {display_height})')
+            image = image.resize((display_width, display_height), Image.Resampling.BILINEAR)
+
+    # Convert to RGB exactly once here (and not at all if the screenshot already is RGB)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    data = np.asarray(image)
+    # Rotate the image by 90° (counterclockwise, like Image.rotate), both rotations are strided views and copy nothing
+    if is_portrait:
+        logging.debug('Rotating image (portrait mode).')
+        data = np.rot90(data)
+    if is_topdown:
+        logging.debug('Rotating image (topdown mode).')
+        data = data[::-1, ::-1]
+
+    return create_buffers(epd, data)
 
 
 async def refresh():
@@ -194,58 +294,35 @@ async def refresh():
         logging.error(f"Refresh operation timed out after {total_timeout} seconds")
         raise
 
+async def refresh_once():
+    try:
+        await refresh()
+    finally:
+        await close_browser()
+
 async def _refresh_internal():
     logging.info('Starting refresh.')
     logging.info('Initializing / waking screen.')
     epd = EPD()
-    epd.init()
-    logging.info('Screen initialized')
-    with tempfile.NamedTemporaryFile(suffix='.png') as tmp_file:
-        logging.info(f'Created temporary file at {tmp_file.name}.')
-        await create_screenshot(tmp_file.name)
+    # The screen is woken on a worker thread while Chromium loads and renders the page
+    epd_init = asyncio.create_task(asyncio.to_thread(epd.init))
+    try:
+        page_hash, screenshot = await create_screenshot()
+    finally:
+        await epd_init
+        logging.info('Screen initialized')
+    if screenshot is None:
+        logging.info('Skipping display update.')
+    else:
         logging.info('Opening screenshot.')
-        image = Image.open(tmp_file)
+        image = Image.open(io.BytesIO(screenshot))
         # image = Image.open('screenshot.png')
-        
-        # Resize image to match display dimensions if needed
-        if image.size != (display_width, display_height):
-            logging.debug(f'Resizing image from {image.size} to ({display_width}, {display_height})')
-            image = image.resize((display_width, display_height), Image.Resampling.LANCZOS)
-        
-        # Replace all colors with are neither black nor red with white
-        image = remove_aliasing_artefacts(image)
-        image = PIL.ImageOps.invert(image)
-        # Rotate the image by 90°
-        if is_portrait:
-           logging.debug('Rotating image (portrait mode).')
-           image = image.rotate(90)
-        if is_topdown:
-           logging.debug('Rotating image (topdown mode).')
-           image = image.rotate(180)
-        
-        # Split the image into black and red components
-        black_image = Image.new('1', image.size, 255)
-        red_image = Image.new('1', image.size, 255)
-        
-        # Convert to RGB if not already
-        data = np.array(image)
-        
-        # Create masks for black and red
-        black_mask = np.all(data == [0, 0, 0], axis=2)
-        red_mask = np.all(data == [255, 0, 0], axis=2)
-        
-        # Apply masks to create black and red images
-        black_data = np.array(black_image)
-        red_data = np.array(red_image)
-        black_data[black_mask] = 0
-        red_data[red_mask] = 0
-        
-        black_image = Image.fromarray(black_data)
-        red_image = Image.fromarray(red_data)
-        
+        black_buffer, red_buffer = prepare_buffers(epd, image)
         logging.info('Sending image to screen.')
-        epd.display(epd.getbuffer(black_image), epd.getbuffer(red_image))
+        # Only the SPI transfer and the panel refresh run off the event loop
+        await asyncio.to_thread(epd.display, black_buffer, red_buffer)
         logging.info('Image sent to display')
+        save_page_hash(page_hash)
     logging.info('Sending display back to sleep.')
     epd.sleep()
     logging.info('Refresh finished.')
@@ -266,7 +343,7 @@ def main():
 
         if not args.reset:
             logging.info('Running refresh once.')
-            asyncio.get_event_loop().run_until_complete(refresh())
+            asyncio.run(refresh_once())
     except KeyboardInterrupt:
         logging.info('Shutting down after receiving a keyboard interrupt.')
     finally: